@@ -1,14 +1,18 @@
 # anx_device_plugin/__init__.py
 
-import os, stat, re, hashlib, json, time, uuid
+import os, re, hashlib, time, uuid
 import sqlite3
-from datetime import datetime
+import traceback
+from datetime import datetime, timezone
+from functools import lru_cache
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait
 import shutil
 
 from calibre.devices.usbms.driver import USBMS
 from calibre.utils.config import JSONConfig
-from calibre.utils.logging import default_log
-from PyQt5.QtWidgets import QLabel, QLineEdit, QVBoxLayout, QWidget
+from calibre.utils.logging import default_log, DEBUG
 from calibre.devices.usbms.books import Book as USBMSBook, CollectionsBookList # Import Book as USBMSBook and CollectionsBookList
 from calibre.library import db # Import calibre.library.db
 
@@ -18,6 +22,119 @@ from .config import ConfigWidget, prefs
 # Define FAKE_DEVICE_SERIAL globally for consistent use
 FAKE_DEVICE_SERIAL = 'ANX_VIRTUAL_DEVICE_PATH:'
 
+# Upper bound on worker threads used for file I/O: copying and hashing books in upload_books and
+# stat'ing them in load_books_from_device. hashlib releases the GIL while digesting large buffers,
+# so hashing several books scales with the CPU count.
+_IO_WORKERS = min(8, os.cpu_count() or 1)
+# Seconds a device layout check stays valid; calibre polls the device state on a timer
+_LAYOUT_CHECK_TTL = 3.0
+# Seconds detect_managed_devices reuses its last answer for an unchanged device_path
+_DETECT_TTL = 2.0
+
+# SQL statements reused across calls; sqlite3 caches prepared statements by their text
+_SQL_INSERT_BOOK = """
+    INSERT INTO tb_books (title, cover_path, file_path, author, create_time, update_time, file_md5, last_read_position, reading_percentage, is_deleted, rating, group_id, description)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+_SQL_SELECT_BOOK_BY_ID = """
+    SELECT id, title, author, file_path, cover_path, file_md5,
+           create_time, update_time, last_read_position,
+           reading_percentage, is_deleted, rating, group_id, description
+    FROM tb_books WHERE id = ?;
+"""
+_SQL_SELECT_BOOKS_AFTER_ID = """
+    SELECT id, title, author, file_path, cover_path, file_md5,
+           create_time, update_time, last_read_position,
+           reading_percentage, is_deleted, rating, group_id, description
+    FROM tb_books WHERE id > ?;
+"""
+_SQL_SELECT_ACTIVE_BOOKS = """
+    SELECT id, title, author, file_path, cover_path, file_md5,
+           create_time, update_time, last_read_position,
+           reading_percentage, is_deleted, rating, group_id, description
+    FROM tb_books WHERE is_deleted != 1;
+"""
+_SQL_SELECT_BOOKS_FOR_SYNC = """
+    SELECT id, title, author, cover_path, file_path, file_md5,
+           create_time, update_time, last_read_position,
+           reading_percentage, is_deleted, rating, group_id, description
+    FROM tb_books;
+"""
+_SQL_SELECT_BOOK_MD5S = "SELECT id, file_md5, is_deleted, file_path FROM tb_books ORDER BY id;"
+_SQL_SELECT_MAX_BOOK_ID = "SELECT COALESCE(MAX(id), 0) FROM tb_books;"
+_SQL_REACTIVATE_BOOK = """
+    UPDATE tb_books
+    SET is_deleted = 0, update_time = ?, file_path = ?, cover_path = ?
+    WHERE id = ?;
+"""
+_SQL_UPDATE_BOOK_FILE_PATH = "UPDATE tb_books SET file_path = ?, update_time = ? WHERE id = ?;"
+_SQL_SOFT_DELETE_BOOK = "UPDATE tb_books SET is_deleted = 1, update_time = ? WHERE id = ?;"
+# Writes every metadata column sync_booklists compares, so the statement text never changes
+_SQL_UPDATE_BOOK_METADATA = """
+    UPDATE tb_books
+    SET title = :title, author = :author, cover_path = :cover_path, file_path = :file_path,
+        file_md5 = :file_md5, create_time = :create_time, last_read_position = :last_read_position,
+        reading_percentage = :reading_percentage, rating = :rating, group_id = :group_id,
+        description = :description, update_time = :update_time
+    WHERE id = :id;
+"""
+_SQL_TB_BOOKS_EXISTS = "SELECT name FROM sqlite_master WHERE type='table' AND name='tb_books';"
+
+class ImageWrapper:
+    # Stands in for cover bytes in book.thumbnail: calibre's device view reads image_path
+    # on demand, as it does for the Kobo driver's thumbnails
+    def __init__(self, image_path):
+        self.image_path = image_path
+
+class AnxBookList(CollectionsBookList):
+    # CollectionsBookList that also indexes its books by uuid and by normalized path, so the
+    # driver can look books up without keeping a second dict in sync with the list
+    def __init__(self, oncard, prefix, settings):
+        CollectionsBookList.__init__(self, oncard, prefix, settings)
+        self.books_by_uuid = {}
+        self.books_by_path = {}
+        self._uuids_by_path = {} # normalized path -> every uuid in books_by_uuid for that book
+
+    def add_book(self, book, replace_metadata):
+        # Same contract as BookList.add_book, which finds an existing book with list.index
+        # (a path comparison against every book); the path index makes the check O(1)
+        path_key = os.path.normpath(book.path)
+        existing = self.books_by_path.get(path_key)
+        if existing is None:
+            self.append(book)
+            self.books_by_path[path_key] = book
+            self._index_uuid(path_key, book.uuid, book)
+            return book
+        if replace_metadata:
+            old_uuid = existing.uuid
+            existing.smart_update(book, replace_metadata=True)
+            if existing.uuid != old_uuid:
+                self.books_by_uuid.pop(old_uuid, None)
+                self._uuids_by_path[path_key].discard(old_uuid)
+            self._index_uuid(path_key, existing.uuid, existing)
+        # A book sent again to an already listed file keeps the listed entry, but must
+        # still be found under its own uuid
+        self._index_uuid(path_key, book.uuid, existing)
+        return existing if replace_metadata else None
+
+    def _index_uuid(self, path_key, book_uuid, book):
+        self.books_by_uuid[book_uuid] = book
+        self._uuids_by_path.setdefault(path_key, set()).add(book_uuid)
+
+    def remove_book(self, book):
+        CollectionsBookList.remove_book(self, book)
+        path_key = os.path.normpath(book.path)
+        for book_uuid in self._uuids_by_path.pop(path_key, ()):
+            self.books_by_uuid.pop(book_uuid, None)
+        self.books_by_uuid.pop(book.uuid, None)
+        self.books_by_path.pop(path_key, None)
+
+    def clear(self):
+        CollectionsBookList.clear(self)
+        self.books_by_uuid.clear()
+        self.books_by_path.clear()
+        self._uuids_by_path.clear()
+
 class AnxDevicePlugin(USBMS): # Change base class to USBMS
     name                = 'ANX Virtual Device'
     gui_name = _('ANX Device')
@@ -44,6 +161,13 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         super().__init__(plugin_path) # Call USBMS's __init__ or DevicePlugin's __init__
         self.gui = None
         self.prefs = prefs
+        self._blacklist_cache = None # Loaded from prefs on first use
+        self._layout_check = None # (base_dir, monotonic time, result) of the last _verify_layout
+        self._conn = None # Long-lived connection to database7.db, see _get_conn
+        self._opened = False # Between a successful open() and eject(); only then is _conn kept
+        self._conn_key = None # (db_path, st_dev, st_ino) the connection was opened for
+        self._tb_books_check = None # ((db_path, st_ino, st_mtime_ns), result) of the last tb_books probe
+        self._last_detect = None # (device_path, monotonic time, result) of the last detect_managed_devices
         self.log = default_log
         if not hasattr(self, 'uuid') or not self.uuid:
             self.uuid = str(uuid.uuid4())
@@ -54,12 +178,12 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.base_dir = None
         self.connected = False
         self.seen_device = False # Added for managed device presence
-        self.books_in_device = {} # Manually initialize books_in_device
-        # Use CollectionsBookList as it handles collections and is preferred
+        # Use CollectionsBookList as it handles collections and is preferred;
+        # AnxBookList adds the books_by_uuid index used for lookups by uuid
         self._main_prefix = prefs['device_path'] + os.sep if prefs['device_path'] else None
         self._card_a_prefix = None
         self._card_b_prefix = None
-        self.booklist = CollectionsBookList(prefix=self._main_prefix, settings=None, oncard=None)
+        self.booklist = AnxBookList(prefix=self._main_prefix, settings=None, oncard=None)
         self.is_connected = False
 
     def load_actual_plugin(self, gui):
@@ -78,6 +202,7 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         config_widget.save_settings()
 
     def apply_settings(self):
+        self._last_detect = None # The device path may have changed
         self.base_dir = prefs['device_path']
         # Reset connection status initially
         self.connected = False
@@ -95,21 +220,9 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.cover_dir = os.path.join(self.base_dir, 'data', 'cover')
 
         # Validate paths immediately after setting them
-        if not os.path.isdir(self.base_dir):
-            self.log.warning(f"ANX Device: Base directory does not exist or is not a directory: {self.base_dir}")
-            return # Exit early if base_dir is invalid
-
-        if not os.path.isfile(self.db_path):
-            self.log.warning(f"ANX Device: Database file not found: {self.db_path}")
-            return # Exit early if db_path is invalid
-
-        if not os.path.isdir(self.file_dir):
-            self.log.warning(f"ANX Device: File directory does not exist or is not a directory: {self.file_dir}")
-            return # Exit early if file_dir is invalid
-
-        if not os.path.isdir(self.cover_dir):
-            self.log.warning(f"ANX Device: Cover directory does not exist or is not a directory: {self.cover_dir}")
-            return # Exit early if cover_dir is invalid
+        if not self._layout_valid():
+            self.log.warning(f"ANX Device: Invalid device layout under {self.base_dir}; expected database7.db, data/file and data/cover")
+            return # Exit early if any path is invalid
 
         # If all paths are valid, proceed with connection check
         self.connected = self.is_connect_to_this_device()
@@ -141,10 +254,7 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.apply_settings() # Re-apply settings to ensure paths are set and checked
 
         # If base_dir is not valid, ensure the device is reported as not connected
-        if not self.base_dir or not os.path.isdir(self.base_dir) or \
-           not self.db_path or not os.path.isfile(self.db_path) or \
-           not self.file_dir or not os.path.isdir(self.file_dir) or \
-           not self.cover_dir or not os.path.isdir(self.cover_dir):
+        if not self._layout_valid():
             self.connected = False
             self.is_connected = False
             self.log.debug(f"ANX Device: is_usb_connected - Invalid paths detected. Reporting not connected.")
@@ -167,61 +277,75 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         
         # Validate paths after setting base_dir
         # If any path is invalid, set connected status to False and return False
-        if not self.base_dir or not os.path.isdir(self.base_dir):
-            self.log.error(f"ANX Device: Invalid base directory during open: {self.base_dir}")
-            self.connected = False
-            self.is_connected = False
-            return False
-        
-        if not self.db_path or not os.path.isfile(self.db_path):
-            self.log.error(f"ANX Device: Database file not found during open: {self.db_path}")
-            self.connected = False
-            self.is_connected = False
-            return False
-        
-        if not self.file_dir or not os.path.isdir(self.file_dir):
-            self.log.error(f"ANX Device: File directory not found during open: {self.file_dir}")
-            self.connected = False
-            self.is_connected = False
-            return False
-        
-        if not self.cover_dir or not os.path.isdir(self.cover_dir):
-            self.log.error(f"ANX Device: Cover directory not found during open: {self.cover_dir}")
+        if not self._layout_valid():
+            self.log.error(f"ANX Device: Invalid device layout during open. Base: {self.base_dir}, DB: {self.db_path}, File: {self.file_dir}, Cover: {self.cover_dir}")
             self.connected = False
             self.is_connected = False
             return False
 
         self.connected = True
         self.is_connected = True # Update USBMS internal state
+        self._opened = True
         self.current_library_uuid = library_uuid # USBMS expects this
         self.load_books_from_device() # Load books when opened
         return True # Indicate successful open
 
         
-    def is_connect_to_this_device(self, opts=None):
-        # Ensure paths are valid before attempting DB connection
-        if not self.base_dir or not os.path.isdir(self.base_dir):
-            self.log.debug(f"ANX Device: Connection check failed. Base directory invalid: {self.base_dir}")
-            return False
-        
-        if not self.db_path or not os.path.isfile(self.db_path):
-            self.log.debug(f"ANX Device: Connection check failed. Database file invalid: {self.db_path}")
+    def _verify_layout(self):
+        # Verify database7.db, data/file and data/cover with two directory reads
+        # instead of one stat per path (each stat is a round trip on network mounts)
+        if not self.base_dir:
             return False
-        
-        if not self.file_dir or not os.path.isdir(self.file_dir):
-            self.log.debug(f"ANX Device: Connection check failed. File directory invalid: {self.file_dir}")
+        try:
+            with os.scandir(self.base_dir) as it:
+                entries = {e.name: e for e in it}
+            db_entry = entries.get('database7.db')
+            data_entry = entries.get('data')
+            if not db_entry or not db_entry.is_file() or not data_entry or not data_entry.is_dir():
+                return False
+            with os.scandir(data_entry.path) as it:
+                data_entries = {e.name: e for e in it}
+            file_entry = data_entries.get('file')
+            cover_entry = data_entries.get('cover')
+            return bool(file_entry and file_entry.is_dir() and cover_entry and cover_entry.is_dir())
+        except OSError:
             return False
-        
-        if not self.cover_dir or not os.path.isdir(self.cover_dir):
-            self.log.debug(f"ANX Device: Connection check failed. Cover directory invalid: {self.cover_dir}")
+
+    def _layout_valid(self):
+        # _verify_layout, remembered for _LAYOUT_CHECK_TTL seconds per base_dir, so the
+        # checks calibre's polling repeats within one cycle do not hit the disk again
+        now = time.monotonic()
+        cached = self._layout_check
+        if cached and cached[0] == self.base_dir and now - cached[1] < _LAYOUT_CHECK_TTL:
+            return cached[2]
+        result = self._verify_layout()
+        self._layout_check = (self.base_dir, now, result)
+        return result
+
+    def is_connect_to_this_device(self, opts=None):
+        # Ensure paths are valid before attempting DB connection
+        if not self._layout_valid():
+            self.log.debug(f"ANX Device: Connection check failed. Invalid device layout under base directory: {self.base_dir}")
             return False
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tb_books';")
-            table_exists = cursor.fetchone() is not None
-            conn.close()
+            # The probe result holds until database7.db is modified or replaced
+            st = os.stat(self.db_path)
+            check_key = (self.db_path, st.st_ino, st.st_mtime_ns)
+            if self._tb_books_check and self._tb_books_check[0] == check_key:
+                return self._tb_books_check[1]
+            if self._opened:
+                # Opened device: probe on the kept connection
+                table_exists = self._get_conn().execute(_SQL_TB_BOOKS_EXISTS).fetchone() is not None
+            else:
+                # Polling before open() (or for an ignored device) must not leave database7.db open:
+                # on Windows an open connection stops the Anx app from replacing the file
+                conn = sqlite3.connect(self.db_path)
+                try:
+                    table_exists = conn.execute(_SQL_TB_BOOKS_EXISTS).fetchone() is not None
+                finally:
+                    conn.close()
+            self._tb_books_check = (check_key, table_exists)
             if not table_exists:
                 self.log.warning(f"ANX Device: 'tb_books' table not found in database: {self.db_path}")
             return table_exists
@@ -229,76 +353,83 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
             self.log.error(f"ANX Device: Error checking database {self.db_path}: {e}", exc_info=True)
             return False
 
+    def _get_conn(self):
+        # Return the connection to database7.db, opening it on first use. Once the device is
+        # opened it is kept across calls until eject(), and reopened when db_path changes or the file is replaced (the Anx app may
+        # sync a new copy of the database into the folder, which a kept connection would not see).
+        st = os.stat(self.db_path)
+        key = (self.db_path, st.st_dev, st.st_ino)
+        if self._conn is None or self._conn_key != key:
+            self._close_conn()
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn_key = key
+        return self._conn
+
+    def _close_conn(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception as e:
+                self.log.warning(f"ANX Device: Error closing database connection: {e}")
+            self._conn = None
+            self._conn_key = None
+
     def load_books_from_device(self, detected_mime=None):
-        # Clear USBMS's internal booklist and books_in_device before reloading
-        # These are properties of the USBMS base class
-        self.books_in_device.clear()
+        # Clear USBMS's internal booklist (and its uuid index) before reloading
         self.booklist.clear()
         
         # Ensure paths are valid before attempting DB connection
-        if not self.base_dir or not os.path.isdir(self.base_dir) or \
-           not self.db_path or not os.path.isfile(self.db_path) or \
-           not self.file_dir or not os.path.isdir(self.file_dir) or \
-           not self.cover_dir or not os.path.isdir(self.cover_dir):
+        if not self._layout_valid():
             self.log.error(f"ANX Device: Cannot load books. Invalid device paths detected. Base: {self.base_dir}, DB: {self.db_path}, File: {self.file_dir}, Cover: {self.cover_dir}")
             return # Exit early if paths are invalid
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            cursor = self._get_conn().cursor()
             # Select all columns from tb_books to store in user_metadata
-            cursor.execute("""
-                SELECT id, title, author, file_path, cover_path, file_md5,
-                       create_time, update_time, last_read_position,
-                       reading_percentage, is_deleted, rating, group_id, description
-                FROM tb_books WHERE is_deleted != 1;
-            """)
+            cursor.execute(_SQL_SELECT_ACTIVE_BOOKS)
+
+            # One directory read of data/file instead of a path lookup per book; DirEntry
+            # caches its stat, and on Windows the directory read already carries it
+            try:
+                with os.scandir(self.file_dir) as it:
+                    book_files = {e.name: e for e in it}
+            except OSError:
+                book_files = {}
             
-            for row in cursor.fetchall():
+            # Stat the book files on a small pool while books are built on this thread
+            stated_rows = self._stat_rows(cursor, book_files)
+            data_prefix = 'data' + os.sep # lpaths are 'data/<stored path>'; joined by hand per book
+
+            for row, (file_size, file_mtime) in stated_rows:
                 (book_id, title, author, file_path_rel, cover_path_rel, file_md5,
                  create_time, update_time, last_read_position,
                  reading_percentage, is_deleted, rating, group_id, description) = row
-                
-                self.log.debug(f"ANX Device: load_books_from_device - book_id: {book_id}, cover_path_rel from DB: {cover_path_rel}")
-                
+
                 # Normalize paths from DB to current OS path style before joining
                 normalized_file_path_rel = os.path.normpath(file_path_rel)
-                normalized_cover_path_rel = os.path.normpath(cover_path_rel) if cover_path_rel else None
-
-                full_file_path = os.path.join(self.base_dir, 'data', normalized_file_path_rel)
-                full_cover_path = os.path.join(self.base_dir, 'data', normalized_cover_path_rel) if normalized_cover_path_rel else None
 
-                file_size = os.path.getsize(full_file_path) if os.path.exists(full_file_path) else 0
-                file_mtime = datetime.fromtimestamp(os.path.getmtime(full_file_path)) if os.path.exists(full_file_path) else datetime.utcnow()
+                lpath = data_prefix + normalized_file_path_rel
 
                 # Create a USBMS.Book object directly
                 # USBMS.Book constructor: __init__(self, prefix, lpath, size, mtime=None, is_dir=False, is_readonly=False, extra_metadata={})
-                # We need to provide a relative path (lpath) to the book within the device prefix.
-                lpath = os.path.relpath(full_file_path, self.base_dir)
+                # We need to provide a relative path (lpath) to the book within the device prefix,
+                # built above from the stored path rather than with os.path.relpath.
                 
                 book = USBMSBook( # Use USBMSBook
                     prefix=self.base_dir,
                     lpath=lpath,
                     size=file_size,
                 )
-                book.uuid = str(uuid.uuid4()) # Manually generate UUID
-                book.datetime = file_mtime.timetuple() # Set datetime attribute as a full time tuple
+                book.uuid = _book_uuid(book_id) # Stable across reloads
+                book.datetime = file_mtime # Already a full UTC time tuple
                 book.is_dir = False # Set is_dir attribute after creation
                 book.is_readonly = True # Set is_readonly attribute after creation
 
                 # Store ANX specific metadata as user_metadata, including all extended attributes
-                book.set_user_metadata('#anx_db_id', {'datatype': 'int', 'is_multiple': False, '#value#': book_id})
-                book.set_user_metadata('#anx_file_path', {'datatype': 'text', 'is_multiple': False, '#value#': file_path_rel or ''})
-                book.set_user_metadata('#anx_cover_path', {'datatype': 'text', 'is_multiple': False, '#value#': cover_path_rel or ''})
-                book.set_user_metadata('#anx_file_md5', {'datatype': 'text', 'is_multiple': False, '#value#': file_md5 or ''})
-                book.set_user_metadata('#anx_create_time', {'datatype': 'datetime', 'is_multiple': False, '#value#': create_time or ''})
-                book.set_user_metadata('#anx_update_time', {'datatype': 'datetime', 'is_multiple': False, '#value#': update_time or ''})
-                book.set_user_metadata('#anx_last_read_position', {'datatype': 'text', 'is_multiple': False, '#value#': last_read_position or ''})
-                book.set_user_metadata('#anx_reading_percentage', {'datatype': 'float', 'is_multiple': False, '#value#': reading_percentage or 0.0})
-                book.set_user_metadata('#anx_is_deleted', {'datatype': 'int', 'is_multiple': False, '#value#': is_deleted or 1})
-                book.set_user_metadata('#anx_rating', {'datatype': 'float', 'is_multiple': False, '#value#': rating or 0.0})
-                book.set_user_metadata('#anx_group_id', {'datatype': 'int', 'is_multiple': False, '#value#': group_id or 0})
-                book.set_user_metadata('#anx_description', {'datatype': 'text', 'is_multiple': False, '#value#': description or ''})
+                _set_anx_user_metadata(book, (
+                    book_id, file_path_rel or '', cover_path_rel or '', file_md5 or '',
+                    create_time or '', update_time or '', last_read_position or '',
+                    reading_percentage or 0.0, is_deleted or 1, rating or 0.0, group_id or 0, description or ''))
 
                 # Populate standard Book attributes from DB
                 book.title = title
@@ -306,32 +437,49 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                 # Calibre will assign a UUID. We will use user_metadata for our internal ID.
                 # book.uuid = f"anx_book_{book_id}" # Removed manual UUID setting
                 # default_log.info(f"ANX Device: load_books_from_device - Set book.uuid to: {book.uuid}") # Removed log
-                book.has_cover = True if full_cover_path and os.path.exists(full_cover_path) else False
-                book.format_map = {os.path.splitext(full_file_path)[1].lstrip('.').upper(): file_size}
+                # Covers are not touched on disk here; the device view loads thumbnail.image_path on demand
+                book.has_cover = bool(cover_path_rel)
+                book.format_map = {_format_of(normalized_file_path_rel.rpartition(os.sep)[2]): file_size}
                 book.device_id = self.uuid
                 book.in_library = False # Device books are not in library by default
                 book.device_collections = [] # Initialize as empty list
+                book.thumbnail = ImageWrapper(os.path.join(self.base_dir, data_prefix + os.path.normpath(cover_path_rel))) if cover_path_rel else None
 
-                # If cover exists, load thumbnail
-                if book.has_cover:
-                    try:
-                        with open(full_cover_path, 'rb') as f:
-                            book.thumbnail = f.read()
-                    except Exception as ce:
-                        self.log.error(f"Error loading thumbnail for {title}: {ce}")
-                        book.thumbnail = None
-                else:
-                    book.thumbnail = None
-
-                self.books_in_device[book.uuid] = book
                 self.booklist.add_book(book, None) # Use USBMS's BookList.add_book method (which handles duplicates)
                 
-            conn.close()
-            self.log.debug(f"Loaded {len(self.books_in_device)} books from ANX device.")
+            self.log.debug(f"Loaded {len(self.booklist)} books from ANX device.")
         except Exception as e:
-            import traceback
             self.log.error(f"Error loading books from device: {e}")
             self.log.error(traceback.format_exc())
+        finally:
+            # apply_settings also loads books before calibre opens the device; do not keep
+            # database7.db open for it
+            if not self._opened:
+                self._close_conn()
+
+    def _stat_rows(self, rows, book_files):
+        # Yield (row, (size, mtime)) for tb_books rows, in order, with the book files stat'ed on
+        # a small pool: on USB and network mounts every stat is a round trip, and the calls
+        # release the GIL. Only a bounded window of rows is in flight (Executor.map would
+        # submit them all at once), so rows are read off the cursor as books are built.
+        window = _IO_WORKERS * 4
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=_IO_WORKERS) as executor:
+            for row in rows:
+                pending.append((row, executor.submit(self._book_file_stat, row[3], book_files)))
+                if len(pending) >= window:
+                    row, future = pending.popleft()
+                    yield row, future.result()
+            while pending:
+                row, future = pending.popleft()
+                yield row, future.result()
+
+    def _book_file_stat(self, file_path_rel, book_files):
+        # (size, mtime) of a book file; book_files maps names in data/file to their DirEntry
+        file_dir_rel, _, file_name = file_path_rel.rpartition('/')
+        if file_dir_rel == 'file':
+            return _entry_size_and_mtime(book_files.get(file_name))
+        return _file_size_and_mtime(os.path.join(self.base_dir, 'data', os.path.normpath(file_path_rel)))
 
     def detect_managed_devices(self, devices_on_system, force_refresh=False):
         # This method is called when MANAGES_DEVICE_PRESENCE is True
@@ -340,13 +488,19 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         device_path = prefs['device_path']
         self.log.debug(f"ANX Device: detect_managed_devices - configured device_path: {device_path}")
         
-        # Immediate check for valid device path
-        if not device_path or not os.path.isdir(device_path):
-            self.log.debug(f"ANX Device: No valid device path configured or path does not exist: {device_path}. Not detecting device.")
+        # Immediate check for a configured device path
+        if not device_path:
+            self.log.debug(f"ANX Device: No device path configured. Not detecting device.")
             self.seen_device = False
             self.connected = False
             self.is_connected = False
-            return False # Return False if path is invalid or not configured
+            return False # Return False if path is not configured
+
+        # calibre calls this on a timer; answer repeated polls for the same path from the last result
+        now = time.monotonic()
+        last = self._last_detect
+        if not force_refresh and last and last[0] == device_path and now - last[1] < _DETECT_TTL:
+            return last[2]
         
         # Set base_dir and sub-paths
         self.base_dir = device_path
@@ -354,19 +508,10 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.file_dir = os.path.join(self.base_dir, 'data', 'file')
         self.cover_dir = os.path.join(self.base_dir, 'data', 'cover')
 
-        # Perform comprehensive path validation before proceeding to DB check
-        if not os.path.isfile(self.db_path) or \
-           not os.path.isdir(self.file_dir) or \
-           not os.path.isdir(self.cover_dir):
-            self.log.debug(f"ANX Device: Sub-paths invalid for {self.base_dir}. Not detecting device.")
-            self.seen_device = False
-            self.connected = False
-            self.is_connected = False
-            return False # Return False if any sub-path is invalid
-
-        # If all paths are valid, then perform the full connection check using is_connect_to_this_device
+        # is_connect_to_this_device validates the layout (two directory reads: base dir and data/) before the DB check
         is_connected = self.is_connect_to_this_device()
         self.log.debug(f"ANX Device: detect_managed_devices.is_connect_to_this_device() returned: {is_connected}")
+        self._last_detect = (device_path, now, is_connected)
         
         if is_connected:
             self.log.debug(f"ANX Device detected at: {device_path}")
@@ -375,7 +520,7 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
             self.is_connected = True
             return True # Return True if device is fully connected
         else:
-            self.log.warning(f"ANX Device path is valid, but connection check failed for: {device_path}")
+            self.log.debug(f"ANX Device: Connection check failed for: {device_path}. Not detecting device.")
             self.seen_device = False
             self.connected = False
             self.is_connected = False
@@ -398,10 +543,9 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         return self.gui_name, 'ANX', '1.0.0', 'application/octet-stream', {'path': self.base_dir}
 
     def get_book_formats(self, book_id):
-        book = self.books_in_device.get(book_id)
+        book = self.booklist.books_by_uuid.get(book_id)
         if book and book.path:
-            ext = os.path.splitext(book.path)[1].lstrip('.').upper()
-            return {ext: book.path}
+            return {_format_of(book.path.rpartition(os.sep)[2]): book.path}
         return {}
 
     def get_can_send_to(self, fmt, mi, plugin_data):
@@ -411,6 +555,8 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
 
     def delete_books(self, book_ids, callback=None, end_session=True):
         self.log.debug(f"ANX Device: delete_books called with book_ids: {book_ids}")
+        if not book_ids:
+            return True # Nothing to delete
         deleted_count = 0
         total_to_delete = len(book_ids)
 
@@ -419,23 +565,25 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         books_to_remove_from_db = []
         books_to_remove_from_cache = []
 
-        self.log.debug(f"ANX Device: Current books in device cache (paths): {[os.path.normpath(b.path) for b in self.booklist]}")
-        self.log.debug(f"ANX Device: Current books in device cache (UUIDs): {[b.uuid for b in self.booklist]}")
+        # These dumps walk the whole booklist, so only build them when debug output is shown
+        debug = self._debug_enabled()
+        if debug:
+            self.log.debug(f"ANX Device: Current books in device cache (paths): {list(self.booklist.books_by_path)}")
+            self.log.debug(f"ANX Device: Current books in device cache (UUIDs): {list(self.booklist.books_by_uuid)}")
 
-        # Build a temporary map for efficient lookup based on UUID or normalized path
-        temp_book_map = {}
-        for book_obj in self.books_in_device.values(): # Iterate over values (USBMSBook objects)
-            temp_book_map[book_obj.uuid] = book_obj # Map Calibre's UUID to the book object
-            temp_book_map[os.path.normpath(book_obj.path)] = book_obj # Map normalized path to the book object
+        # AnxBookList keeps the books indexed by UUID and by normalized path
+        books_by_uuid = self.booklist.books_by_uuid
+        books_by_path = self.booklist.books_by_path
 
         for item_to_delete in book_ids:
-            self.log.debug(f"ANX Device: Attempting to delete item: {item_to_delete}")
+            if debug:
+                self.log.debug(f"ANX Device: Attempting to delete item: {item_to_delete}")
             book_to_delete = None
 
             # Try to find by UUID first, then by normalized path
-            book_to_delete = temp_book_map.get(item_to_delete)
+            book_to_delete = books_by_uuid.get(item_to_delete)
             if not book_to_delete:
-                book_to_delete = temp_book_map.get(os.path.normpath(item_to_delete))
+                book_to_delete = books_by_path.get(os.path.normpath(item_to_delete))
 
             if book_to_delete:
                 # Use the absolute paths directly from USBMSBook's attributes
@@ -444,24 +592,28 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                 
                 # Construct the full absolute path for the cover file
                 cover_path = os.path.join(self.base_dir, 'data', os.path.normpath(cover_path_rel)) if cover_path_rel else None
-                self.log.debug(f"ANX Device: Found book in cache. {book_to_delete.get_all_user_metadata(make_copy=False)} Path: {book_path}, Cover Path (absolute): {cover_path}")
+                if debug:
+                    self.log.debug(f"ANX Device: Found book in cache. {book_to_delete.get_all_user_metadata(make_copy=False)} Path: {book_path}, Cover Path (absolute): {cover_path}")
 
-                # Delete file
-                if os.path.exists(book_path):
-                    try:
-                        os.remove(book_path)
+                # Delete file; removing directly avoids a separate existence check
+                try:
+                    os.remove(book_path)
+                    if debug:
                         self.log.debug(f"ANX Device: Successfully deleted file: {book_path}")
-                        deleted_count += 1
-                    except Exception as e:
-                        self.log.error(f"ANX Device: Error deleting file {book_path}: {e}", exc_info=True)
-                else:
+                    deleted_count += 1
+                except FileNotFoundError:
                     self.log.debug(f"ANX Device: File not found on disk: {book_path}")
+                except Exception as e:
+                    self.log.error(f"ANX Device: Error deleting file {book_path}: {e}", exc_info=True)
 
                 # Delete cover file
-                if cover_path and os.path.exists(cover_path):
+                if cover_path:
                     try:
                         os.remove(cover_path)
-                        self.log.debug(f"ANX Device: Successfully deleted cover file: {cover_path}")
+                        if debug:
+                            self.log.debug(f"ANX Device: Successfully deleted cover file: {cover_path}")
+                    except FileNotFoundError:
+                        pass
                     except Exception as e:
                         self.log.error(f"ANX Device: Error deleting cover file {cover_path}: {e}", exc_info=True)
 
@@ -470,44 +622,42 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
             else:
                 self.log.warning(f"ANX Device: Book or path '{item_to_delete}' not found in device cache. Skipping deletion.")
 
-        # Remove from database
-        if books_to_remove_from_db:
+        deleted_books = []
+        for book in books_to_remove_from_db:
+            # Retrieve ANX DB ID
+            anx_db_id = book.get('#anx_db_id') # Use .get() method
+
+            if anx_db_id is not None:
+                deleted_books.append((book, anx_db_id))
+            else:
+                self.log.warning(f"ANX Device: Could not find #anx_db_id in user_metadata for book {book.uuid}. Skipping DB deletion and in-memory removal.")
+
+        # Remove from database; no connection is opened when no book matched
+        if deleted_books:
             conn = None
             try:
-                conn = sqlite3.connect(self.db_path)
+                # Shared connection, as in sync_booklists and upload_books
+                conn = self._get_conn()
                 cursor = conn.cursor()
-                for book in books_to_remove_from_db:
-                    # Retrieve ANX DB ID
-                    anx_db_id = book.get('#anx_db_id') # Use .get() method
-
-                    if anx_db_id is not None:
-                        current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                        cursor.execute("UPDATE tb_books SET is_deleted = 1, update_time = ? WHERE id = ?", (current_time, anx_db_id))
-                        self.log.debug(f"ANX Device: Updata entries for book with ANX DB ID {anx_db_id} from tb_books.")
-                        #cursor.execute("DELETE FROM tb_reading_time WHERE book_id = ?", (anx_db_id,))
-                        #self.log.debug(f"ANX Device: Deleted entries for book with ANX DB ID {anx_db_id} from tb_reading_time.")
-                        #cursor.execute("DELETE FROM tb_notes WHERE book_id = ?", (anx_db_id,))
-                        #self.log.debug(f"ANX Device: Deleted entries for book with ANX DB ID {anx_db_id} from tb_notes.")
-                        # Remove from in-memory cache and booklist directly
-                        if book.uuid in self.books_in_device:
-                            del self.books_in_device[book.uuid]
-                            self.log.debug(f"ANX Device: Removed book {book.uuid} from self.books_in_device cache.")
-                        
-                        # Remove from booklist (which is CollectionsBookList)
-                        # CollectionsBookList has a remove_book method
-                        try:
-                            self.booklist.remove_book(book)
-                            self.log.debug(f"ANX Device: Removed book {book.uuid} from self.booklist.")
-                        except Exception as list_e:
-                            self.log.error(f"ANX Device: Error removing book {book.uuid} from booklist: {list_e}")
-                    else:
-                        self.log.warning(f"ANX Device: Could not find #anx_db_id in user_metadata for book {book.uuid}. Skipping DB deletion and in-memory removal.")
+                current_time = _utc_timestamp()
+                # Soft-delete every book with one prepared statement in one transaction
+                cursor.executemany(_SQL_SOFT_DELETE_BOOK,
+                                   [(current_time, anx_db_id) for book, anx_db_id in deleted_books])
+                #cursor.execute("DELETE FROM tb_reading_time WHERE book_id = ?", (anx_db_id,))
+                #cursor.execute("DELETE FROM tb_notes WHERE book_id = ?", (anx_db_id,))
                 conn.commit()
+                self.log.debug(f"ANX Device: Marked {len(deleted_books)} books as deleted in tb_books.")
+                # Remove from booklist (which is AnxBookList) once the database agrees
+                # AnxBookList.remove_book also drops the book from its uuid index
+                for book, anx_db_id in deleted_books:
+                    try:
+                        self.booklist.remove_book(book)
+                    except Exception as list_e:
+                        self.log.error(f"ANX Device: Error removing book {book.uuid} from booklist: {list_e}")
             except Exception as e:
                 self.log.error(f"ANX Device: Error deleting books from database: {e}", exc_info=True)
-            finally:
-                if conn:
-                    conn.close()
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
 
 
         self.report_progress(1.0, 'Finished deleting books.')
@@ -518,6 +668,10 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
 
     def eject(self):
         self.is_connected = False
+        self._opened = False
+        self._layout_check = None # Re-check the layout on the next poll
+        self._last_detect = None
+        self._close_conn()
 
 
     def settings(self):
@@ -539,7 +693,7 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         return 'EBOOK'
 
     def get_metadata(self, book_id, allow_cache=True):
-        book = self.books_in_device.get(book_id) # This is now a Book object
+        book = self.booklist.books_by_uuid.get(book_id) # This is now a Book object
         if book:
             return book # Book object already contains all necessary metadata and inherits from Metadata
         return None
@@ -551,8 +705,12 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         
         actual_file_path = path
 
-        if os.path.exists(actual_file_path):
-            file_size = os.path.getsize(actual_file_path)
+        # One stat gives both existence and size
+        try:
+            file_size = os.stat(actual_file_path).st_size
+        except OSError:
+            file_size = None
+        if file_size is not None:
             self.log.debug(f"ANX Device: get_file - File exists at {actual_file_path}, size: {file_size} bytes.")
             if file_size == 0:
                 self.log.error(f"ANX Device: get_file - File at {actual_file_path} has zero size!")
@@ -571,14 +729,19 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         return False # Indicate failure
 
     def get_cover(self, book_id, as_file=False):
-        book = self.books_in_device.get(book_id)
+        book = self.booklist.books_by_uuid.get(book_id)
         if book and book.has_cover:
-            cover_path = book.get('#anx_cover_path')
-            if cover_path and os.path.exists(cover_path):
-                if as_file:
-                    return open(cover_path, 'rb')
-                with open(cover_path, 'rb') as f:
-                    return f.read()
+            # '#anx_cover_path' is stored relative to the device's data folder
+            cover_path_rel = book.get('#anx_cover_path')
+            cover_path = os.path.join(self.base_dir, 'data', os.path.normpath(cover_path_rel)) if cover_path_rel else None
+            if cover_path:
+                try:
+                    if as_file:
+                        return open(cover_path, 'rb')
+                    with open(cover_path, 'rb') as f:
+                        return f.read()
+                except FileNotFoundError:
+                    pass
         return None
 
     def get_icon(self):
@@ -611,31 +774,39 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.log.debug("ANX Device: sync_booklists called.")
         
         main_booklist = booklists[0] # The main booklist from Calibre's USBMS driver
+        # Every book changed in this sync gets the same update_time
+        current_time = _utc_timestamp()
+        debug = self._debug_enabled()
+        # One connection for the whole sync, shared with the other driver methods
+        try:
+            conn = self._get_conn()
+        except Exception as e:
+            self.log.error(f"ANX Device: sync_booklists - Could not open database {self.db_path}: {e}", exc_info=True)
+            return False
+        cursor = conn.cursor()
+        # Read the stored values of every book with one query instead of one SELECT per book.
+        # A full scan keeps the statement constant and avoids SQLite's limit on IN (...) parameters.
+        try:
+            db_rows = {row[0]: row[1:] for row in cursor.execute(_SQL_SELECT_BOOKS_FOR_SYNC)}
+        except Exception as e:
+            self.log.error(f"ANX Device: sync_booklists - Could not read tb_books: {e}", exc_info=True)
+            return False
+        pending_updates = [] # Parameter dicts for _SQL_UPDATE_BOOK_METADATA, written together after the loop
         
         # Iterate through the books in the main_booklist
         for book_obj in main_booklist:
+            # Fetch the book's user metadata dict once and read every ANX field from it
+            user_metadata = book_obj.get_all_user_metadata(make_copy=False)
             # Get ANX DB ID
-            anx_db_id = book_obj.get('#anx_db_id') # Use .get() method
+            anx_db_id = user_metadata.get('#anx_db_id', {}).get('#value#')
 
             if anx_db_id is None:
                 self.log.warning(f"ANX Device: sync_booklists - Could not find #anx_db_id in user_metadata for book {book_obj.uuid}. Skipping metadata update for this book.")
                 continue
 
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                
                 # Retrieve current metadata from DB to check for changes for all relevant fields
-                cursor.execute("""
-                    SELECT title, author, cover_path, file_path, file_md5,
-                           create_time, update_time, last_read_position,
-                           reading_percentage, is_deleted, rating, group_id, description
-                    FROM tb_books WHERE id = ?;
-                """, (anx_db_id,))
-                
-                db_data = cursor.fetchone()
+                db_data = db_rows.get(anx_db_id)
                 if not db_data:
                     self.log.warning(f"ANX Device: sync_booklists - Book with ANX DB ID {anx_db_id} not found in database. Skipping metadata update.")
                     continue
@@ -644,80 +815,77 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                  db_create_time, db_update_time, db_last_read_position,
                  db_reading_percentage, db_is_deleted, db_rating, db_group_id, db_description) = db_data
                 
-                update_fields = []
-                update_values = []
+                # Start from the stored values and overwrite the ones that changed; any change is
+                # written with the fixed _SQL_UPDATE_BOOK_METADATA statement
+                new_values = {
+                    'title': db_title, 'author': db_author, 'cover_path': db_cover_path,
+                    'file_path': db_file_path, 'file_md5': db_file_md5, 'create_time': db_create_time,
+                    'last_read_position': db_last_read_position, 'reading_percentage': db_reading_percentage,
+                    'rating': db_rating, 'group_id': db_group_id, 'description': db_description,
+                }
+                changed = False
                 
                 # Compare and update title
                 if book_obj.title != db_title:
-                    update_fields.append("title = ?")
-                    update_values.append(book_obj.title)
-                    self.log.debug(f"ANX Device: sync_booklists - Title changed for book ID {anx_db_id}: '{db_title}' -> '{book_obj.title}'")
+                    new_values['title'] = book_obj.title
+                    changed = True
+                    if debug:
+                        self.log.debug(f"ANX Device: sync_booklists - Title changed for book ID {anx_db_id}: '{db_title}' -> '{book_obj.title}'")
                 
                 # Compare and update author
                 current_author_in_book = book_obj.authors[0] if book_obj.authors else ''
                 if current_author_in_book != db_author:
-                    update_fields.append("author = ?")
-                    update_values.append(current_author_in_book)
-                    self.log.debug(f"ANX Device: sync_booklists - Author changed for book ID {anx_db_id}: '{db_author}' -> '{current_author_in_book}'")
-
-                # Compare and update other extended attributes from user_metadata
-                fields_to_check = {
-                    '#anx_cover_path': ('cover_path', db_cover_path, 'text'),
-                    '#anx_file_path': ('file_path', db_file_path, 'text'), # file_path is not usually editable by user directly, but for completeness
-                    '#anx_file_md5': ('file_md5', db_file_md5, 'text'), # file_md5 is not editable
-                    '#anx_create_time': ('create_time', db_create_time, 'datetime'),
-                    '#anx_last_read_position': ('last_read_position', db_last_read_position, 'text'),
-                    '#anx_reading_percentage': ('reading_percentage', db_reading_percentage, 'float'),
-                    '#anx_rating': ('rating', db_rating, 'float'),
-                    '#anx_group_id': ('group_id', db_group_id, 'int'),
-                    '#anx_description': ('description', db_description, 'text'),
-                }
-
-                for user_meta_key, (db_field_name, db_current_value, data_type) in fields_to_check.items():
-                    user_meta_val = book_obj.get(user_meta_key) # Use .get() method
+                    new_values['author'] = current_author_in_book
+                    changed = True
+                    if debug:
+                        self.log.debug(f"ANX Device: sync_booklists - Author changed for book ID {anx_db_id}: '{db_author}' -> '{current_author_in_book}'")
+
+                # Compare and update other extended attributes from user_metadata;
+                # new_values still holds the stored value of each of these columns
+                for user_meta_key, db_field_name, convert in _SYNC_USER_METADATA_FIELDS:
+                    db_current_value = new_values[db_field_name]
+                    user_meta_entry = user_metadata.get(user_meta_key)
+                    user_meta_val = user_meta_entry.get('#value#') if user_meta_entry else None
                     
                     # Convert rating from Calibre's 0-10 to ANX's 0-5
                     #if db_field_name == 'rating' and user_meta_val is not None:
                     #    user_meta_val = float(user_meta_val) / 2
                     
                     # Type conversion for comparison
-                    if data_type == 'float' and user_meta_val is not None:
-                        try:
-                            user_meta_val = float(user_meta_val)
-                        except (ValueError, TypeError):
-                            user_meta_val = 0.0 # Default if conversion fails
-                    elif data_type == 'int' and user_meta_val is not None:
-                        try:
-                            user_meta_val = int(user_meta_val)
-                        except (ValueError, TypeError):
-                            user_meta_val = 0 # Default if conversion fails
+                    if convert is not None and user_meta_val is not None:
+                        user_meta_val = convert(user_meta_val)
                     
                     if user_meta_val != db_current_value:
-                        update_fields.append(f"{db_field_name} = ?")
-                        update_values.append(user_meta_val)
-                        self.log.debug(f"ANX Device: sync_booklists - {db_field_name} changed for book ID {anx_db_id}: '{db_current_value}' -> '{user_meta_val}'")
-
-                if update_fields:
-                    update_fields.append("update_time = ?")
-                    update_values.append(current_time) # Update update_time on any change
-                    
-                    sql_update = f"UPDATE tb_books SET {', '.join(update_fields)} WHERE id = ?;"
-                    update_values.append(anx_db_id)
+                        new_values[db_field_name] = user_meta_val
+                        changed = True
+                        if debug:
+                            self.log.debug(f"ANX Device: sync_booklists - {db_field_name} changed for book ID {anx_db_id}: '{db_current_value}' -> '{user_meta_val}'")
+
+                if changed:
+                    new_values['update_time'] = current_time # Update update_time on any change
+                    new_values['id'] = anx_db_id
                     
-                    self.log.debug(f"ANX Device: sync_booklists - SQL Update: {sql_update}")
-                    self.log.debug(f"ANX Device: sync_booklists - Update Values: {update_values}")
+                    if debug:
+                        self.log.debug(f"ANX Device: sync_booklists - Update Values: {new_values}")
                     
-                    cursor.execute(sql_update, tuple(update_values))
-                    conn.commit()
-                    self.log.debug(f"ANX Device: Successfully updated metadata for book with ANX DB ID {anx_db_id} in database.")
-                else:
+                    pending_updates.append(new_values)
+                elif debug:
                     self.log.debug(f"ANX Device: No metadata changes detected for book ID {anx_db_id}.")
                 
             except Exception as e:
                 self.log.error(f"ANX Device: Error updating metadata for book {book_obj.uuid} (ANX DB ID: {anx_db_id}) in database during sync_booklists: {e}", exc_info=True)
-            finally:
-                if conn:
-                    conn.close()
+
+        # Write every changed book with one prepared statement and commit them at once:
+        # one journal sync per sync instead of one per changed book
+        try:
+            if pending_updates:
+                cursor.executemany(_SQL_UPDATE_BOOK_METADATA, pending_updates)
+                self.log.debug(f"ANX Device: Successfully updated metadata for {len(pending_updates)} books in database.")
+            conn.commit()
+        except Exception as e:
+            self.log.error(f"ANX Device: Error committing metadata changes during sync_booklists: {e}", exc_info=True)
+            conn.rollback()
+            return False
         self.log.debug("ANX Device: sync_booklists finished.")
         return True # Indicate success
 
@@ -728,184 +896,73 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
 
 
         locations = []
+        # One connection (kept by _get_conn), cursor, transaction and timestamp for the whole batch
+        current_time = _utc_timestamp()
+        # Load every known MD5 once instead of issuing one SELECT per book.
+        # Maps file_md5 -> [id, is_deleted, file_path] and is kept current as books are added below.
+        known_md5s = {}
+        pending_inserts = [] # Row tuples for _SQL_INSERT_BOOK
+        pending_locations = [] # (index in locations, file_md5, fmt, file_size) for each pending row
+        try:
+            conn = self._get_conn()
+            cursor = conn.cursor()
+            for book_id, book_md5, book_is_deleted, book_file_path in cursor.execute(_SQL_SELECT_BOOK_MD5S):
+                known_md5s.setdefault(book_md5, [book_id, book_is_deleted, book_file_path])
+        except Exception as e:
+            # Nothing has been copied yet
+            self.log.error(f"ANX Device: upload_books - Could not read database {self.db_path}: {e}", exc_info=True)
+            self.report_progress(1.0, 'Finished sending books.')
+            return []
+        # Books that are active on the device right now; workers skip copying these.
+        # Taken as a snapshot so the workers never read a dict this thread is updating.
+        active_md5s = {book_md5: entry[2] for book_md5, entry in known_md5s.items() if entry[1] != 1}
+        # No makedirs here: open() only connects when data/file and data/cover already exist
+        # Copying, hashing and cover writing run on a small thread pool; every SQLite
+        # statement below stays on this thread.
+        executor = ThreadPoolExecutor(max_workers=max(1, min(_IO_WORKERS, total_books)))
+        staging = self._submit_staging(executor, files, metadata, active_md5s)
+        debug = self._debug_enabled()
         for i, src_path in enumerate(files):
             try:
                 self.report_progress(float(i) / total_books, f'Sending book {i+1} of {total_books}')
                 
                 book_data = metadata[i]
-                self.log.debug(f"ANX Device: upload_books - book_data.cover_data: {book_data.cover_data}")
-                
-                title = book_data.title if book_data.title else os.path.splitext(os.path.basename(src_path))[0]
-                author = book_data.authors[0] if book_data.authors else "Unknown"
-                
-                
-                fmt = os.path.splitext(src_path)[1].lstrip('.').lower()
-                if not fmt:
-                    fmt = 'epub'
-                # Ensure the filename is based on safe title and author, preserving UTF-8, and handle length
-                filename = self._get_safe_filename(title, author, fmt)
-                dest_file_path = os.path.join(self.file_dir, filename)
-                
-                os.makedirs(self.file_dir, exist_ok=True)
-                os.makedirs(self.cover_dir, exist_ok=True)
-                
-                shutil.copyfile(src_path, dest_file_path)
-                self.log.debug(f"Copied ebook from {src_path} to {dest_file_path}")
-                
-                file_md5 = hashlib.md5(open(dest_file_path, 'rb').read()).hexdigest()
-                
-                cover_path_rel = ""
-                dest_cover_path = "" # Initialize dest_cover_path
-                
-                cover_data_to_write = None
-                cover_extension = '.jpg' # Default extension
-
-                # 1. Preferred cover extraction: Use book_data.cover (path to cover file)
-                if book_data and hasattr(book_data, 'cover') and book_data.cover:
-                    calibre_cover_path = book_data.cover
-                    self.log.debug(f"ANX Device: upload_books - Attempting to use book_data.cover path: {calibre_cover_path}")
-                    if os.path.exists(calibre_cover_path):
-                        try:
-                            with open(calibre_cover_path, 'rb') as f:
-                                cover_data_to_write = f.read()
-                            cover_extension = os.path.splitext(calibre_cover_path)[1].lower()
-                            self.log.debug(f"ANX Device: upload_books - Successfully read cover from book_data.cover path: {calibre_cover_path}.")
-                        except Exception as e:
-                            self.log.error(f"ANX Device: Error reading cover from book_data.cover path {calibre_cover_path}: {e}")
-                            cover_data_to_write = None
-                    else:
-                        self.log.warning(f"ANX Device: book_data.cover path does not exist: {calibre_cover_path}")
-
-                # 2. Fallback to Calibre DB if book_data.cover is not available or failed
-                if not cover_data_to_write:
-                    self.log.debug(f"ANX Device: upload_books - book_data.cover not available or failed, falling back to Calibre DB.")
-                    try:
-                        calibre_db = db().new_api # Use db().new_api to access the Calibre database API directly
-                        self.log.debug(f"ANX Device: upload_books - book_data.id: {book_data.id}, calibre_db: {calibre_db}")
-                        
-                        # Get full metadata including cover_data
-                        current_metadata = calibre_db.get_metadata(book_data.id, get_cover=True)
-                        cover_rel_path = current_metadata.get('cover')
-                        
-                        if cover_rel_path:
-                            book_library_path = calibre_db.field_for('path', book_data.id)
-                            calibre_cover_path = os.path.join(book_library_path, cover_rel_path)
-                            self.log.debug(f"ANX Device: upload_books - calibre_cover_path from DB metadata: {calibre_cover_path}")
-
-                            if os.path.exists(calibre_cover_path):
-                                try:
-                                    with open(calibre_cover_path, 'rb') as f:
-                                        cover_data_to_write = f.read()
-                                    cover_extension = os.path.splitext(calibre_cover_path)[1].lower()
-                                    self.log.debug(f"ANX Device: upload_books - Successfully read cover from Calibre DB path: {calibre_cover_path}.")
-                                except Exception as e:
-                                    self.log.error(f"ANX Device: Error reading cover from Calibre DB path {calibre_cover_path}: {e}")
-                                    cover_data_to_write = None
-                            else:
-                                self.log.warning(f"ANX Device: No valid cover file found at {calibre_cover_path} for book {title} in Calibre DB.")
-                        else:
-                            self.log.warning(f"ANX Device: No cover path found in metadata for book {title} in Calibre DB.")
-                    except sqlite3.OperationalError as db_e:
-                        self.log.warning(f"ANX Device: Could not access Calibre DB for cover: {db_e}. This might be due to a 'database is locked' error. Skipping cover extraction from DB.")
-                        cover_data_to_write = None # Ensure cover_data_to_write is None on DB error
-                    except Exception as e:
-                        self.log.error(f"ANX Device: Unexpected error accessing Calibre DB for cover: {e}", exc_info=True)
-                        cover_data_to_write = None # Ensure cover_data_to_write is None on unexpected error
-
-                # 3. Fallback to book_data.cover_data (format, data) tuple
-                if not cover_data_to_write and book_data and hasattr(book_data, 'cover_data') and book_data.cover_data and len(book_data.cover_data) == 2 and book_data.cover_data[1]:
-                    cover_data_to_write = book_data.cover_data[1]
-                    cover_format = book_data.cover_data[0].lower() if book_data.cover_data[0] else 'jpeg'
-                    if cover_format == 'png':
-                        cover_extension = '.png'
-                    elif cover_format == 'gif':
-                        cover_extension = '.gif'
-                    self.log.debug(f"ANX Device: upload_books - Using cover data from book_data.cover_data as a fallback.")
-
-                # 4. Fallback to book_data.thumbnail (width, height, cover_data as jpeg)
-                if not cover_data_to_write and book_data and hasattr(book_data, 'thumbnail') and book_data.thumbnail and len(book_data.thumbnail) == 3:
-                    cover_data_to_write = book_data.thumbnail[2] # Get the actual image data
-                    cover_extension = '.jpg' # Assuming thumbnail is always JPEG
-                    self.log.debug(f"ANX Device: upload_books - Using cover data from book_data.thumbnail as a last resort.")
-
-                dest_cover_path = "" # Initialize dest_cover_path
-                if cover_data_to_write:
-                    # Use _get_safe_filename for cover filename as well
-                    # For cover, we pass the extension as fmt to _get_safe_filename
-                    cover_filename = self._get_safe_filename(title, author, cover_extension.lstrip('.'))
-                    dest_cover_path = os.path.join(self.cover_dir, cover_filename)
-                    
-                    try:
-                        with open(dest_cover_path, 'wb') as f:
-                            f.write(cover_data_to_write)
-                        cover_path_rel = os.path.relpath(dest_cover_path, os.path.join(self.base_dir, 'data')).replace(os.sep, '/')
-                        self.log.debug(f"Copied cover to {dest_cover_path}")
-                    except Exception as ce:
-                        self.log.error(f"Error copying cover data to {dest_cover_path}: {ce}")
-                        cover_path_rel = "" # Reset cover_path_rel if copy fails
-                        dest_cover_path = "" # Reset dest_cover_path if copy fails
-                else:
-                    self.log.warning(f"No cover data available to write for book {title}.")
-                    cover_path_rel = ""
-                    dest_cover_path = ""
+                staged = staging[i].result()
+                title, author, fmt = staged['title'], staged['author'], staged['fmt']
+                dest_file_path = staged['dest_file_path']
+                file_md5 = staged['file_md5']
+                file_size = staged['file_size'] # The copy has the source's size, so no stat of the new file
+                cover_path_rel = staged['cover_path_rel']
                 
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                if dest_file_path is None:
+                    # _stage_book found this book active on the device with its file present and skipped the copy
+                    self.log.warning(f"Book '{title}' with MD5 '{file_md5}' already exists and file is present. Skipping as duplicate.")
+                    continue
 
-                cursor.execute("SELECT id, is_deleted, file_path FROM tb_books WHERE file_md5 = ?;", (file_md5,))
-                existing_book = cursor.fetchone()
+                existing_book = known_md5s.get(file_md5)
 
                 if existing_book:
                     existing_id, is_deleted, file_path_rel_from_db = existing_book
                     # Case 1: MD5 exists and is_deleted is 1 (book was soft-deleted)
                     if is_deleted == 1:
-                        self.log.debug(f"Book '{title}' with MD5 '{file_md5}' exists but is marked as deleted. Reactivating and updating.")
+                        if debug:
+                            self.log.debug(f"Book '{title}' with MD5 '{file_md5}' exists but is marked as deleted. Reactivating and updating.")
                         # File has already been copied, so we just update the database record
-                        file_relative_path = os.path.relpath(dest_file_path, os.path.join(self.base_dir, 'data')).replace(os.sep, '/')
+                        file_relative_path = staged['file_path_rel']
                         
-                        current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                        cursor.execute("""
-                            UPDATE tb_books 
-                            SET is_deleted = 0, update_time = ?, file_path = ?, cover_path = ?
-                            WHERE id = ?;
-                        """, (current_time, file_relative_path, cover_path_rel, existing_id))
-                        conn.commit()
-                        self.log.debug(f"Reactivated book with ID {existing_id}.")
+                        cursor.execute(_SQL_REACTIVATE_BOOK, (current_time, file_relative_path, cover_path_rel, existing_id))
+                        existing_book[1:] = [0, file_relative_path]
+                        if debug:
+                            self.log.debug(f"Reactivated book with ID {existing_id}.")
 
                         # After reactivating, we must add it to the booklist to update the UI
-                        cursor.execute("""
-                            SELECT id, title, author, file_path, cover_path, file_md5,
-                                   create_time, update_time, last_read_position,
-                                   reading_percentage, is_deleted, rating, group_id, description
-                            FROM tb_books WHERE id = ?;
-                        """, (existing_id,))
+                        cursor.execute(_SQL_SELECT_BOOK_BY_ID, (existing_id,))
                         
                         row = cursor.fetchone()
                         if row:
-                            (book_id, title, author, file_path_rel, cover_path_rel, file_md5,
-                             create_time, update_time, last_read_position,
-                             reading_percentage, is_deleted, rating, group_id, description) = row
-
-                            full_file_path = os.path.join(self.base_dir, 'data', os.path.normpath(file_path_rel))
-                            full_cover_path = os.path.join(self.base_dir, 'data', os.path.normpath(cover_path_rel)) if cover_path_rel else None
-                            file_size = os.path.getsize(full_file_path) if os.path.exists(full_file_path) else 0
-                            file_mtime = datetime.fromtimestamp(os.path.getmtime(full_file_path)) if os.path.exists(full_file_path) else datetime.utcnow()
-
-                            book_info = {
-                                'book_id': book_id, 'title': title, 'author': author,
-                                'file_path_rel': file_path_rel, 'cover_path_rel': cover_path_rel,
-                                'file_md5': file_md5, 'create_time': create_time, 'update_time': update_time,
-                                'last_read_position': last_read_position, 'reading_percentage': reading_percentage,
-                                'is_deleted': is_deleted, 'rating': rating, 'group_id': group_id,
-                                'description': description, 'full_file_path': full_file_path,
-                                'full_cover_path': full_cover_path, 'file_size': file_size,
-                                'file_mtime': file_mtime, 'fmt': fmt
-                            }
-                            locations.append((full_file_path, None, book_info))
+                            locations.append(self._book_location(row, fmt, file_size))
                             sent_count += 1 # Increment sent_count as it's a successful "upload"
 
-                        conn.close()
                         continue
                     
                     # Case 2: MD5 exists and is_deleted is 0 (book is active)
@@ -913,23 +970,22 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                         full_file_path_on_device = os.path.join(self.base_dir, 'data', os.path.normpath(file_path_rel_from_db))
                         # Case 2a: File does not exist on disk
                         if not os.path.exists(full_file_path_on_device):
-                            self.log.debug(f"Book '{title}' with MD5 '{file_md5}' exists, but file is missing. Replacing file.")
+                            if debug:
+                                self.log.debug(f"Book '{title}' with MD5 '{file_md5}' exists, but file is missing. Replacing file.")
                             # The file has already been copied to dest_file_path by this point.
                             # We just need to ensure the DB path is correct if it changed.
-                            file_relative_path = os.path.relpath(dest_file_path, os.path.join(self.base_dir, 'data')).replace(os.sep, '/')
+                            file_relative_path = staged['file_path_rel']
                             if file_relative_path != file_path_rel_from_db:
-                                current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                                cursor.execute("UPDATE tb_books SET file_path = ?, update_time = ? WHERE id = ?", (file_relative_path, current_time, existing_id))
-                                conn.commit()
+                                cursor.execute(_SQL_UPDATE_BOOK_FILE_PATH, (file_relative_path, current_time, existing_id))
+                                existing_book[2] = file_relative_path
                             # We don't need to do anything else, the file is now where it should be.
                         # Case 2b: File exists on disk
                         else:
                             self.log.warning(f"Book '{title}' with MD5 '{file_md5}' already exists and file is present. Skipping as duplicate.")
                         
-                        conn.close()
                         continue
                 
-                file_relative_path = os.path.relpath(dest_file_path, os.path.join(self.base_dir, 'data')).replace(os.sep, '/')
+                file_relative_path = staged['file_path_rel']
                 
                 # Extract extended attributes from book_data
                 # Provide default values if attributes are not present in book_data
@@ -944,11 +1000,8 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                 group_id = book_data.get('group_id', 0)
                 description = book_data.get('description', '')
 
-                sql_insert = """
-                INSERT INTO tb_books (title, cover_path, file_path, author, create_time, update_time, file_md5, last_read_position, reading_percentage, is_deleted, rating, group_id, description)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                """
-                cursor.execute(sql_insert, (
+                # Queue the row; all new books are inserted together after the loop
+                pending_inserts.append((
                     title,
                     cover_path_rel,
                     file_relative_path,
@@ -963,74 +1016,290 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                     group_id,
                     description
                 ))
-                conn.commit()
-                book_id_from_db = cursor.lastrowid
-                # After inserting, select the full book data to construct the USBMSBook object
-                cursor.execute("""
-                    SELECT id, title, author, file_path, cover_path, file_md5,
-                           create_time, update_time, last_read_position,
-                           reading_percentage, is_deleted, rating, group_id, description
-                    FROM tb_books WHERE id = ?;
-                """, (book_id_from_db,))
-                
-                row = cursor.fetchone()
-                conn.close() # Close connection after query
-                
-                if not row:
-                    self.log.error(f"ANX Device: Failed to retrieve book with ID {book_id_from_db} after insertion. Skipping location return.")
-                    continue # Skip to next book if data retrieval fails
-
-                (book_id, title, author, file_path_rel, cover_path_rel, file_md5,
-                 create_time, update_time, last_read_position,
-                 reading_percentage, is_deleted, rating, group_id, description) = row
-
-                self.log.debug(f"Book '{title}' successfully added to ANX device database with ID: {book_id_from_db}.")
-                sent_count += 1
-
-                # Normalize paths from DB to current OS path style before joining
-                normalized_file_path_rel = os.path.normpath(file_path_rel)
-                normalized_cover_path_rel = os.path.normpath(cover_path_rel) if cover_path_rel else None
-
-                full_file_path = os.path.join(self.base_dir, 'data', normalized_file_path_rel)
-                full_cover_path = os.path.join(self.base_dir, 'data', normalized_cover_path_rel) if normalized_cover_path_rel else None
-
-                file_size = os.path.getsize(full_file_path) if os.path.exists(full_file_path) else 0
-                file_mtime = datetime.fromtimestamp(os.path.getmtime(full_file_path)) if os.path.exists(full_file_path) else datetime.utcnow()
-
-                # Prepare a dictionary with all necessary info for add_books_to_metadata
-                book_info = {
-                    'book_id': book_id,
-                    'title': title,
-                    'author': author,
-                    'file_path_rel': file_path_rel,
-                    'cover_path_rel': cover_path_rel,
-                    'file_md5': file_md5,
-                    'create_time': create_time,
-                    'update_time': update_time,
-                    'last_read_position': last_read_position,
-                    'reading_percentage': reading_percentage,
-                    'is_deleted': is_deleted,
-                    'rating': rating,
-                    'group_id': group_id,
-                    'description': description,
-                    'full_file_path': full_file_path,
-                    'full_cover_path': full_cover_path,
-                    'file_size': file_size,
-                    'file_mtime': file_mtime,
-                    'fmt': fmt # Original format
-                }
-                
-                locations.append((full_file_path, None, book_info)) # Pass book_info as the third element in the tuple
+                pending_locations.append((len(locations), file_md5, fmt, file_size))
+                locations.append(None) # Filled in once the row has its ID
+                known_md5s[file_md5] = [None, is_deleted, file_relative_path]
 
             except Exception as e:
                 self.log.error(f"Error sending book {os.path.basename(src_path)}: {e}") # Use src_path for logging
-                import traceback
                 self.log.error(traceback.format_exc())
                 continue
+        executor.shutdown()
+
+        # Insert all new books with one prepared statement, then read them back in one query
+        # to get their IDs. Rows are matched on file_md5, which is unique within the batch.
+        if pending_inserts:
+            try:
+                max_id_before = cursor.execute(_SQL_SELECT_MAX_BOOK_ID).fetchone()[0]
+                if not conn.in_transaction:
+                    cursor.execute("BEGIN")
+                # executemany stops at the first failing row and keeps the rows before it, so the
+                # batch runs under a savepoint; on failure it is undone and retried one row at a time
+                cursor.execute("SAVEPOINT anx_insert_books")
+                try:
+                    cursor.executemany(_SQL_INSERT_BOOK, pending_inserts)
+                except sqlite3.Error as e:
+                    self.log.warning(f"ANX Device: Batch insert of uploaded books failed, inserting them one at a time: {e}")
+                    cursor.execute("ROLLBACK TO anx_insert_books")
+                    self._insert_books_one_by_one(cursor, pending_inserts)
+                cursor.execute("RELEASE anx_insert_books")
+                inserted_rows = {row[5]: row for row in cursor.execute(_SQL_SELECT_BOOKS_AFTER_ID, (max_id_before,))}
+            except Exception as e:
+                # Nothing of this batch is committed, as when the commit below fails
+                self.log.error(f"ANX Device: Error inserting uploaded books into database: {e}", exc_info=True)
+                conn.rollback()
+                self.report_progress(1.0, 'Finished sending books.')
+                return []
+            for slot, file_md5, fmt, file_size in pending_locations:
+                row = inserted_rows.get(file_md5)
+                if not row:
+                    self.log.error(f"ANX Device: Failed to retrieve book with MD5 {file_md5} after insertion. Skipping location return.")
+                    continue
+                if debug:
+                    self.log.debug(f"Book '{row[1]}' successfully added to ANX device database with ID: {row[0]}.")
+                locations[slot] = self._book_location(row, fmt, file_size)
+                sent_count += 1
+            locations = [location for location in locations if location is not None]
+
+        # Commit every insert/update of the batch at once: one journal sync instead of one per book
+        try:
+            conn.commit()
+        except Exception as e:
+            self.log.error(f"ANX Device: Error committing uploaded books to database: {e}", exc_info=True)
+            conn.rollback()
+            locations = []
         
         self.report_progress(1.0, 'Finished sending books.')
         return locations # Return only locations list
 
+    def _insert_books_one_by_one(self, cursor, rows):
+        # Insert rows for _SQL_INSERT_BOOK individually, each under its own savepoint, so a
+        # failing book is skipped without affecting the others. upload_books then finds no
+        # row for the skipped book and leaves it out of the returned locations.
+        for row in rows:
+            cursor.execute("SAVEPOINT anx_insert_book")
+            try:
+                cursor.execute(_SQL_INSERT_BOOK, row)
+            except sqlite3.Error as e:
+                self.log.error(f"ANX Device: Error inserting book '{row[0]}' into database: {e}")
+                cursor.execute("ROLLBACK TO anx_insert_book")
+            cursor.execute("RELEASE anx_insert_book")
+
+    def _book_location(self, row, fmt, file_size=None):
+        # Build the (path, card, book_info) location returned by upload_books from a tb_books row.
+        # file_size is passed for a file that was just copied; its mtime is then the current time.
+        (book_id, title, author, file_path_rel, cover_path_rel, file_md5,
+         create_time, update_time, last_read_position,
+         reading_percentage, is_deleted, rating, group_id, description) = row
+
+        # Normalize paths from DB to current OS path style before joining
+        full_file_path = os.path.join(self.base_dir, 'data', os.path.normpath(file_path_rel))
+        full_cover_path = os.path.join(self.base_dir, 'data', os.path.normpath(cover_path_rel)) if cover_path_rel else None
+
+        if file_size is None:
+            file_size, file_mtime = _file_size_and_mtime(full_file_path)
+        else:
+            file_mtime = time.gmtime()
+
+        # Prepare a dictionary with all necessary info for add_books_to_metadata
+        book_info = {
+            'book_id': book_id,
+            'title': title,
+            'author': author,
+            'file_path_rel': file_path_rel,
+            'cover_path_rel': cover_path_rel,
+            'file_md5': file_md5,
+            'create_time': create_time,
+            'update_time': update_time,
+            'last_read_position': last_read_position,
+            'reading_percentage': reading_percentage,
+            'is_deleted': is_deleted,
+            'rating': rating,
+            'group_id': group_id,
+            'description': description,
+            'full_file_path': full_file_path,
+            'full_cover_path': full_cover_path,
+            'file_size': file_size,
+            'file_mtime': file_mtime,
+            'fmt': fmt # Original format
+        }
+        return (full_file_path, None, book_info) # Pass book_info as the third element in the tuple
+
+    def _submit_staging(self, executor, files, metadata, active_md5s):
+        # Queue the filesystem half of every upload. A book waits for every earlier book that
+        # may write one of its destination files (the ebook or any possible cover name), so
+        # no two workers write the same path concurrently.
+        futures = []
+        last_by_name = {}
+        library_covers = self._library_cover_paths(metadata)
+        for src_path, book_data in zip(files, metadata):
+            title = book_data.title if book_data.title else os.path.splitext(os.path.basename(src_path))[0]
+            author = book_data.authors[0] if book_data.authors else "Unknown"
+            fmt = os.path.splitext(src_path)[1].lstrip('.').lower()
+            if not fmt:
+                fmt = 'epub'
+            library_cover_path = library_covers.get(getattr(book_data, 'id', None))
+            name_keys = self._destination_names(title, author, fmt, book_data, library_cover_path)
+            previous = {last_by_name[key] for key in name_keys if key in last_by_name}
+            future = executor.submit(self._stage_book, src_path, book_data, title, author, fmt, active_md5s, library_cover_path, previous)
+            for key in name_keys:
+                last_by_name[key] = future
+            futures.append(future)
+        return futures
+
+    def _destination_names(self, title, author, fmt, book_data, library_cover_path):
+        # Every file _stage_book may write for a book, as (directory, lower-cased name):
+        # the ebook, and the cover under each extension its cover sources can give it
+        cover_extensions = {'.jpg', '.png', '.gif'} # cover_data and thumbnail fallbacks
+        for cover_path in (getattr(book_data, 'cover', None), library_cover_path):
+            if cover_path:
+                cover_extensions.add(os.path.splitext(cover_path)[1].lower())
+        names = {('file', self._get_safe_filename(title, author, fmt).lower())}
+        names.update(('cover', self._get_safe_filename(title, author, ext.lstrip('.')).lower()) for ext in cover_extensions)
+        return names
+
+    def _library_cover_paths(self, metadata):
+        # Resolve library cover files for the books whose metadata carries no usable cover path.
+        # Opens the Calibre library once and reads every needed path in one batched call.
+        # Returns {book id: absolute cover path, or None if the book has no cover}.
+        book_ids = [book_data.id for book_data in metadata
+                    if getattr(book_data, 'id', None) is not None
+                    and not (getattr(book_data, 'cover', None) and os.path.isfile(book_data.cover))]
+        if not book_ids:
+            return {}
+        self.log.debug(f"ANX Device: upload_books - book_data.cover not available for {len(book_ids)} books, falling back to Calibre DB.")
+        try:
+            calibre_db = db().new_api # Use db().new_api to access the Calibre database API directly
+            library_path = calibre_db.backend.library_path
+            has_cover = calibre_db.all_field_for('cover', book_ids)
+            book_paths = calibre_db.all_field_for('path', book_ids)
+        except sqlite3.OperationalError as db_e:
+            self.log.warning(f"ANX Device: Could not access Calibre DB for cover: {db_e}. This might be due to a 'database is locked' error. Skipping cover extraction from DB.")
+            return {}
+        except Exception as e:
+            self.log.error(f"ANX Device: Unexpected error accessing Calibre DB for cover: {e}", exc_info=True)
+            return {}
+        # Calibre keeps each book's cover as cover.jpg in the book's folder
+        return {book_id: os.path.join(library_path, book_paths[book_id], 'cover.jpg') if has_cover.get(book_id) and book_paths.get(book_id) else None
+                for book_id in book_ids}
+
+    def _stage_book(self, src_path, book_data, title, author, fmt, active_md5s, library_cover_path=None, previous=None):
+        # Hash the ebook, then copy it and write its cover unless it is already on the device.
+        # Runs on a worker thread and never touches SQLite.
+        if previous:
+            wait(previous)
+        debug = self._debug_enabled()
+        if debug:
+            cover_data = book_data.cover_data
+            self.log.debug(f"ANX Device: upload_books - book_data.cover_data: {(cover_data[0], len(cover_data[1] or b'')) if cover_data and len(cover_data) == 2 else cover_data}")
+
+        # Ensure the filename is based on safe title and author, preserving UTF-8, and handle length
+        filename = self._get_safe_filename(title, author, fmt)
+        dest_file_path = os.path.join(self.file_dir, filename)
+        # Paths in tb_books are relative to data/ with '/' separators; file_dir is always data/file
+        file_path_rel = f"file/{filename}"
+        
+        # Hash the source first, so a book that is already on the device is never copied
+        file_md5, file_size = _md5_file(src_path)
+        existing_file_path_rel = active_md5s.get(file_md5)
+        if existing_file_path_rel and os.path.exists(os.path.join(self.base_dir, 'data', os.path.normpath(existing_file_path_rel))):
+            if debug:
+                self.log.debug(f"ANX Device: upload_books - {src_path} is already on the device as {existing_file_path_rel}. Skipping copy.")
+            return {
+                'title': title,
+                'author': author,
+                'fmt': fmt,
+                'dest_file_path': None,
+                'file_path_rel': None,
+                'file_md5': file_md5,
+                'file_size': file_size,
+                'cover_path_rel': '',
+            }
+        
+        _copy_file(src_path, dest_file_path)
+        if debug:
+            self.log.debug(f"Copied ebook from {src_path} to {dest_file_path}")
+        
+        cover_path_rel = ""
+        dest_cover_path = "" # Initialize dest_cover_path
+        
+        cover_data_to_write = None
+        cover_extension = '.jpg' # Default extension
+
+        # 1. Preferred cover extraction: Use book_data.cover (path to cover file)
+        # 2. Fallback to the cover file in the Calibre library, resolved up front by _library_cover_paths
+        # Cover files are copied file-to-file without checking for them first; a missing
+        # file shows up as FileNotFoundError from the copy and the next source is tried.
+        cover_src_paths = [path for path in (getattr(book_data, 'cover', None), library_cover_path) if path]
+        if not cover_src_paths:
+            self.log.warning(f"ANX Device: No cover path found in metadata for book {title} in Calibre DB.")
+        for calibre_cover_path in cover_src_paths:
+            if debug:
+                self.log.debug(f"ANX Device: upload_books - Attempting to use cover path: {calibre_cover_path}")
+            cover_extension = os.path.splitext(calibre_cover_path)[1].lower()
+            # Use _get_safe_filename for cover filename as well
+            # For cover, we pass the extension as fmt to _get_safe_filename
+            cover_filename = self._get_safe_filename(title, author, cover_extension.lstrip('.'))
+            dest_cover_path = os.path.join(self.cover_dir, cover_filename)
+            try:
+                _copy_file(calibre_cover_path, dest_cover_path)
+            except FileNotFoundError:
+                self.log.warning(f"ANX Device: Cover path does not exist: {calibre_cover_path}")
+                continue
+            except Exception as ce:
+                self.log.error(f"Error copying cover from {calibre_cover_path} to {dest_cover_path}: {ce}")
+                continue
+            cover_path_rel = f"cover/{cover_filename}"
+            if debug:
+                self.log.debug(f"Copied cover to {dest_cover_path}")
+            break
+        else:
+            dest_cover_path = ""
+
+        # 3. Fallback to book_data.cover_data (format, data) tuple
+        if not cover_path_rel and book_data and hasattr(book_data, 'cover_data') and book_data.cover_data and len(book_data.cover_data) == 2 and book_data.cover_data[1]:
+            cover_data_to_write = book_data.cover_data[1]
+            cover_format = book_data.cover_data[0].lower() if book_data.cover_data[0] else 'jpeg'
+            cover_extension = '.jpg'
+            if cover_format == 'png':
+                cover_extension = '.png'
+            elif cover_format == 'gif':
+                cover_extension = '.gif'
+            self.log.debug(f"ANX Device: upload_books - Using cover data from book_data.cover_data as a fallback.")
+
+        # 4. Fallback to book_data.thumbnail (width, height, cover_data as jpeg)
+        if not cover_path_rel and not cover_data_to_write and book_data and hasattr(book_data, 'thumbnail') and book_data.thumbnail and len(book_data.thumbnail) == 3:
+            cover_data_to_write = book_data.thumbnail[2] # Get the actual image data
+            cover_extension = '.jpg' # Assuming thumbnail is always JPEG
+            self.log.debug(f"ANX Device: upload_books - Using cover data from book_data.thumbnail as a last resort.")
+
+        if cover_data_to_write:
+            cover_filename = self._get_safe_filename(title, author, cover_extension.lstrip('.'))
+            dest_cover_path = os.path.join(self.cover_dir, cover_filename)
+                    
+            try:
+                _write_file(dest_cover_path, cover_data_to_write)
+                cover_path_rel = f"cover/{cover_filename}"
+                if debug:
+                    self.log.debug(f"Copied cover to {dest_cover_path}")
+            except Exception as ce:
+                self.log.error(f"Error copying cover data to {dest_cover_path}: {ce}")
+                cover_path_rel = "" # Reset cover_path_rel if copy fails
+                dest_cover_path = "" # Reset dest_cover_path if copy fails
+        elif not cover_path_rel:
+            self.log.warning(f"No cover data available to write for book {title}.")
+
+        return {
+            'title': title,
+            'author': author,
+            'fmt': fmt,
+            'dest_file_path': dest_file_path,
+            'file_path_rel': file_path_rel,
+            'file_md5': file_md5,
+            'file_size': file_size,
+            'cover_path_rel': cover_path_rel,
+        }
+
     def books(self, oncard=None, end_session=True):
         # Return USBMS's internal booklist directly
         return self.booklist
@@ -1045,26 +1314,35 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
         self.log.debug(f"ANX Device: ignore_connected_device called for UID: {uid}")
         blacklisted_devices = self.get_user_blacklisted_devices()
         if uid not in blacklisted_devices:
-            blacklisted_devices[uid] = f"ANX Device ({uid})" # Store with a friendly name
-            self.set_user_blacklisted_devices(blacklisted_devices)
+            if isinstance(blacklisted_devices, dict):
+                self.set_user_blacklisted_devices({**blacklisted_devices, uid: f"ANX Device ({uid})"}) # Store with a friendly name
+            else:
+                self.set_user_blacklisted_devices([*blacklisted_devices, uid])
             self.log.debug(f"ANX Device: Added {uid} to blacklist.")
         
         # Reset plugin state as per interface documentation
         # Reset plugin state as per interface documentation
         self.seen_device = False
         self.connected = False
-        # USBMS base class handles clearing its internal books_in_device and booklist on disconnect/ignore
-        # self.books_in_device.clear() # No need to clear here, USBMS handles it
+        # USBMS base class handles clearing its internal booklist on disconnect/ignore
         # self.booklist.clear() # No need to clear here, USBMS handles it
 
     def get_user_blacklisted_devices(self):
-        # Return a dictionary of blacklisted devices (UID -> friendly name).
-        return self.prefs.get('blacklisted_devices', {})
+        # Return the blacklisted devices: a dict (UID -> friendly name) as stored by
+        # ignore_connected_device, or the list of UIDs calibre's preferences pass in.
+        # Read from prefs once; callers get a copy, so editing it never touches the cache.
+        if self._blacklist_cache is None:
+            self._blacklist_cache = _copy_blacklist(self.prefs.get('blacklisted_devices', {}))
+        return _copy_blacklist(self._blacklist_cache)
 
     def set_user_blacklisted_devices(self, devices):
-        # Set the blacklisted devices.
-        self.prefs['blacklisted_devices'] = devices
-        self.prefs.commit() # Save changes to config file
+        # Set the blacklisted devices (a mapping or any iterable of UIDs). The config file
+        # is only rewritten when the blacklist actually changed; JSONConfig saves it on assignment.
+        devices = _copy_blacklist(devices)
+        if devices == self.get_user_blacklisted_devices():
+            return
+        self._blacklist_cache = devices
+        self.prefs['blacklisted_devices'] = _copy_blacklist(devices)
 
     def do_user_manual(self, gui):
         self.gui.job_manager.show_message('ANX Device Plugin: Manage ebooks in your custom ANX folder structure. Configure the device path in Calibre Preferences -> Plugins -> Device Plugins -> ANX Virtual Device -> Customize plugin.')
@@ -1093,7 +1371,6 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                 file_size = book_info['file_size']
                 file_mtime = book_info['file_mtime']
                 fmt = book_info['fmt']
-                full_cover_path = book_info['full_cover_path']
 
                 # We need the base_dir to construct lpath and check paths
                 # Since this is a classmethod, we cannot access self.base_dir directly.
@@ -1111,81 +1388,243 @@ class AnxDevicePlugin(USBMS): # Change base class to USBMS
                     lpath=lpath,
                     size=file_size,
                 )
-                book.uuid = str(uuid.uuid4())
-                book.datetime = file_mtime.timetuple()
+                book.uuid = _book_uuid(book_id)
+                book.datetime = file_mtime
                 book.is_dir = False
                 book.is_readonly = True
 
                 # Store ANX specific metadata as user_metadata
-                book.set_user_metadata('#anx_db_id', {'datatype': 'int', 'is_multiple': False, '#value#': book_id})
-                book.set_user_metadata('#anx_file_path', {'datatype': 'text', 'is_multiple': False, '#value#': file_path_rel or ''})
-                book.set_user_metadata('#anx_cover_path', {'datatype': 'text', 'is_multiple': False, '#value#': cover_path_rel or ''})
-                book.set_user_metadata('#anx_file_md5', {'datatype': 'text', 'is_multiple': False, '#value#': file_md5 or ''})
-                book.set_user_metadata('#anx_create_time', {'datatype': 'datetime', 'is_multiple': False, '#value#': create_time or ''})
-                book.set_user_metadata('#anx_update_time', {'datatype': 'datetime', 'is_multiple': False, '#value#': update_time or ''})
-                book.set_user_metadata('#anx_last_read_position', {'datatype': 'text', 'is_multiple': False, '#value#': last_read_position or ''})
-                book.set_user_metadata('#anx_reading_percentage', {'datatype': 'float', 'is_multiple': False, '#value#': reading_percentage or 0.0})
-                book.set_user_metadata('#anx_is_deleted', {'datatype': 'int', 'is_multiple': False, '#value#': is_deleted or 0})
-                book.set_user_metadata('#anx_rating', {'datatype': 'float', 'is_multiple': False, '#value#': rating or 0.0})
-                book.set_user_metadata('#anx_group_id', {'datatype': 'int', 'is_multiple': False, '#value#': group_id or 0})
-                book.set_user_metadata('#anx_description', {'datatype': 'text', 'is_multiple': False, '#value#': description or ''})
+                _set_anx_user_metadata(book, (
+                    book_id, file_path_rel or '', cover_path_rel or '', file_md5 or '',
+                    create_time or '', update_time or '', last_read_position or '',
+                    reading_percentage or 0.0, is_deleted or 0, rating or 0.0, group_id or 0, description or ''))
 
                 # Populate standard Book attributes
                 book.title = title
                 book.authors = [author] if author else [_('Unknown')]
-                book.has_cover = True if full_cover_path and os.path.exists(full_cover_path) else False
+                # upload_books only records a cover path once the cover has been written
+                book.has_cover = bool(cover_path_rel)
                 book.format_map = {fmt.upper(): file_size}
                 book.device_id = self.uuid 
                 book.in_library = False
                 book.device_collections = []
 
-                if book.has_cover and os.path.exists(full_cover_path):
-                    try:
-                        with open(full_cover_path, 'rb') as f:
-                            book.thumbnail = f.read()
-                    except Exception as ce:
-                        default_log.error(f"Error loading thumbnail for {title} in add_books_to_metadata: {ce}")
-                        book.thumbnail = None
-                else:
-                    book.thumbnail = None
+                # As in load_books_from_device, the cover is not read here; the device view loads it on demand
+                book.thumbnail = ImageWrapper(book_info['full_cover_path']) if cover_path_rel else None
                 
-                usbms_booklist.add_book(book, on_card_name) # Add to the booklist
-                # Ensure books_in_device is updated for newly added books
-                # This is important for methods like delete_books to find the book
-                # and for load_books_from_device not to re-add it on subsequent calls.
-                self.books_in_device[book.uuid] = book
-                default_log.debug(f"ANX Device: Added book {title} to device metadata and updated books_in_device.")
+                # Add to the booklist; AnxBookList indexes the book by uuid so that
+                # methods like delete_books and get_metadata can find it
+                usbms_booklist.add_book(book, on_card_name)
+                default_log.debug(f"ANX Device: Added book {title} to device metadata.")
 
             except Exception as e:
                 default_log.error(f"ANX Device: Error in add_books_to_metadata for location {full_file_path}: {e}", exc_info=True)
 
+    def remove_books_from_metadata(self, paths, booklists):
+        # USBMS compares every path against every book (O(paths x books)); AnxBookList
+        # finds each path in its books_by_path index instead
+        total_paths = len(paths)
+        for i, path in enumerate(paths):
+            self.report_progress((i + 1) / float(total_paths), 'Removing books from device metadata listing...')
+            normalized_path = os.path.normpath(path)
+            for bl in booklists:
+                books_by_path = getattr(bl, 'books_by_path', None)
+                if books_by_path is not None:
+                    book = books_by_path.get(normalized_path)
+                    if book is not None:
+                        bl.remove_book(book)
+                elif bl:
+                    for book in [b for b in bl if path.endswith(b.path)]:
+                        bl.remove_book(book)
+        self.report_progress(1.0, 'Finished removing books from device metadata listing.')
+
+    def _debug_enabled(self):
+        # Whether debug messages reach the log. calibre's Log has no lazy formatting, so per-book
+        # loops check this before building their debug messages.
+        return self.log.filter_level <= DEBUG
+
     def _get_safe_filename(self, title, author, fmt, max_len=90):
-        # Generate a base filename from title and author
-        base_filename = f"{title} - {author}"
-        
-        # Get the extension with a leading dot
-        ext = f".{fmt}" if fmt else ""
-        
-        # Calculate available length for the base name
-        available_len = max_len - len(ext)
-        
-        if available_len < 1: # Ensure there's at least some space for the base name
-            available_len = 1
-        
-        # Truncate the base filename if it's too long
-        if len(base_filename) > available_len:
-            # For simplicity, we'll just truncate from the end
-            base_filename = base_filename[:available_len]
-            
-        # Combine truncated base filename with extension
-        full_filename = f"{base_filename}{ext}"
-        
-        # Replace any characters that are not allowed in filenames
-        # This is a basic sanitization. Calibre's internal safe_filename might be more robust.
-        # For simplicity, we'll replace common problematic characters with underscores.
-        full_filename = re.sub(r'[<>:"/\\|?*]', '_', full_filename)
+        # Sanitization is memoized at module level, so re-sending the same books skips the string work
+        return _safe_filename(title, author, fmt, max_len)
+
+# Chunk size for streaming file hashes (the buffer size shutil.copyfileobj uses)
+_HASH_CHUNK_SIZE = 256 * 1024
+
+def _md5_file(path):
+    # Stream the file through MD5 with one reused buffer, so memory use does not grow with the book size.
+    # Returns (hexdigest, size); the size is counted from the reads, so callers need no extra stat.
+    h = hashlib.md5()
+    buf = bytearray(_HASH_CHUNK_SIZE)
+    mv = memoryview(buf)
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(mv)
+            if not n:
+                break
+            h.update(mv[:n])
+            size += n
+    return h.hexdigest(), size
+
+# Bytes requested per os.copy_file_range call
+_COPY_CHUNK_SIZE = 1 << 30
+
+def _copy_file(src_path, dest_path):
+    # os.copy_file_range (Linux) copies inside the kernel and becomes a reflink clone on
+    # btrfs/xfs; fall back to shutil.copyfile, which already uses the best copy call elsewhere
+    # Errors opening either file (e.g. FileNotFoundError for a missing source) reach the caller
+    if hasattr(os, 'copy_file_range'):
+        with open(src_path, 'rb') as fsrc, open(dest_path, 'wb') as fdst:
+            try:
+                expected = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while True:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), _COPY_CHUNK_SIZE)
+                    if not n:
+                        break
+                    copied += n
+                # Some filesystems (FUSE, network mounts) return 0 without copying anything,
+                # which looks like end of file; only trust a copy of the whole source
+                if copied == expected and copied:
+                    return
+            except OSError:
+                pass # e.g. unsupported by the filesystem or across devices on older kernels
+    shutil.copyfile(src_path, dest_path)
+
+def _write_file(path, data):
+    # Write a small file (a cover) straight to an unbuffered fd, without the 8 KiB
+    # buffer and extra copy of a buffered file object. os.write may write less than asked.
+    view = memoryview(data)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+# (field, datatype) of the ANX columns kept as user metadata on device books, in tb_books row order
+_ANX_USER_METADATA_FIELDS = (
+    ('#anx_db_id', 'int'),
+    ('#anx_file_path', 'text'),
+    ('#anx_cover_path', 'text'),
+    ('#anx_file_md5', 'text'),
+    ('#anx_create_time', 'datetime'),
+    ('#anx_update_time', 'datetime'),
+    ('#anx_last_read_position', 'text'),
+    ('#anx_reading_percentage', 'float'),
+    ('#anx_is_deleted', 'int'),
+    ('#anx_rating', 'float'),
+    ('#anx_group_id', 'int'),
+    ('#anx_description', 'text'),
+)
+
+def _set_anx_user_metadata(book, values):
+    # Store values (in _ANX_USER_METADATA_FIELDS order) as the book's ANX user metadata.
+    # Writes the entries straight into the book's user metadata dict instead of calling
+    # set_user_metadata, which copies each freshly built dict again.
+    user_metadata = book.get_all_user_metadata(make_copy=False)
+    for (field, datatype), value in zip(_ANX_USER_METADATA_FIELDS, values):
+        user_metadata[field] = {'datatype': datatype, 'is_multiple': False, '#value#': value}
+
+def _float_or_zero(value):
+    # Converter for REAL columns; values Calibre cannot express as a number are stored as 0.0
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+def _int_or_zero(value):
+    # Converter for INTEGER columns; values Calibre cannot express as a number are stored as 0
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return 0
+
+# (user metadata key, tb_books column, converter or None for text) of the ANX fields sync_booklists writes back
+_SYNC_USER_METADATA_FIELDS = (
+    ('#anx_cover_path', 'cover_path', None),
+    ('#anx_file_path', 'file_path', None), # file_path is not usually editable by user directly, but for completeness
+    ('#anx_file_md5', 'file_md5', None), # file_md5 is not editable
+    ('#anx_create_time', 'create_time', None),
+    ('#anx_last_read_position', 'last_read_position', None),
+    ('#anx_reading_percentage', 'reading_percentage', _float_or_zero),
+    ('#anx_rating', 'rating', _float_or_zero),
+    ('#anx_group_id', 'group_id', _int_or_zero),
+    ('#anx_description', 'description', None),
+)
+
+def _utc_timestamp():
+    # Current UTC time as tb_books stores it ('2024-01-31T12:00:00.000000Z'). isoformat is
+    # cheaper than strftime, and datetime.utcnow is deprecated.
+    return datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
+
+def _copy_blacklist(devices):
+    # Copy a device blacklist, keeping its shape: a mapping stays a dict, any other iterable of UIDs becomes a list
+    if isinstance(devices, Mapping):
+        return dict(devices)
+    return list(devices)
+
+def _format_of(file_name):
+    # Upper-case extension of a bare file name ('' if it has none), as os.path.splitext
+    # would give it, with one rpartition instead of a splitext call per book
+    name, dot, ext = file_name.rpartition('.')
+    return ext.upper() if dot and name.strip('.') else ''
+
+# Namespace for the uuids of device books, derived from their tb_books id
+_ANX_BOOK_UUID_NAMESPACE = uuid.UUID('36186ef1-d2c5-5f2f-b512-430748388b72')
+
+def _book_uuid(book_id):
+    # The same tb_books row gets the same uuid on every load, so calibre's references
+    # to device books by uuid stay valid when the booklist is rebuilt
+    return str(uuid.uuid5(_ANX_BOOK_UUID_NAMESPACE, str(book_id)))
+
+def _file_size_and_mtime(path):
+    # One stat for both values; the mtime is a UTC struct_time, the form USBMS books use for .datetime
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0, time.gmtime()
+    return st.st_size, time.gmtime(st.st_mtime)
+
+def _entry_size_and_mtime(entry):
+    # _file_size_and_mtime for an os.DirEntry from scandir (None if the file is missing)
+    if entry is None:
+        return 0, time.gmtime()
+    try:
+        st = entry.stat()
+    except OSError:
+        return 0, time.gmtime()
+    return st.st_size, time.gmtime(st.st_mtime)
+
+# Characters that are not allowed in filenames
+_UNSAFE_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+
+@lru_cache(maxsize=4096)
+def _safe_filename(title, author, fmt, max_len):
+    # Generate a base filename from title and author
+    base_filename = f"{title} - {author}"
+    
+    # Get the extension with a leading dot
+    ext = f".{fmt}" if fmt else ""
+    
+    # Calculate available length for the base name
+    available_len = max_len - len(ext)
+    
+    if available_len < 1: # Ensure there's at least some space for the base name
+        available_len = 1
+    
+    # Truncate the base filename if it's too long
+    if len(base_filename) > available_len:
+        # For simplicity, we'll just truncate from the end
+        base_filename = base_filename[:available_len]
         
-        return full_filename
+    # Combine truncated base filename with extension
+    full_filename = f"{base_filename}{ext}"
+    
+    # Replace any characters that are not allowed in filenames
+    # This is a basic sanitization. Calibre's internal safe_filename might be more robust.
+    # For simplicity, we'll replace common problematic characters with underscores.
+    return _UNSAFE_FILENAME_CHARS.sub('_', full_filename)
 
 class Opts:
     def __init__(self, format_map):